@@ -1,400 +1,652 @@
+import hashlib
+import logging
 import os
+import sys
 import tarfile
 import urllib.request
+from zlib import crc32
+
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs
+import sklearn
+from scipy import stats
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_squared_error
+from sklearn.model_selection import GridSearchCV, cross_val_score, train_test_split
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.tree import DecisionTreeRegressor
+
+logger = logging.getLogger(__name__)
 
 download_root = "https://raw.githubusercontent.com/ageron/handson-ml2/master/"
 HOUSING_PATH = "https://raw.githubusercontent.com/ageron/handson-ml2/master/datasets/housing/housing.csv"
 HOUSING_URL = download_root + "datasets/housing/housing.tgz"
-
-
-def fetch_housing_data(housing_url=HOUSING_URL, housing_path=HOUSING_PATH):
+HOUSING_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ml_book")
+
+HOUSING_DTYPES = {
+    "longitude": "float32",
+    "latitude": "float32",
+    "housing_median_age": "float32",
+    "total_rooms": "float32",
+    "total_bedrooms": "float32",
+    "population": "float32",
+    "households": "float32",
+    "median_income": "float32",
+    "median_house_value": "float32",
+    "ocean_proximity": "category",
+}
+NUM_ATTRIBS = [column for column, dtype in HOUSING_DTYPES.items()
+               if column not in ("median_house_value", "ocean_proximity")]
+CAT_ATTRIBS = ["ocean_proximity"]
+
+CMAP = plt.get_cmap("jet")
+
+
+def fetch_housing_data(housing_url=HOUSING_URL, housing_path=HOUSING_CACHE_DIR):
     os.makedirs(housing_path, exist_ok=True)
     tgz_path = os.path.join(housing_path, "housing.tgz")
-    urllib.request.urlretrieve(housing_url, tgz_path)
+    if not os.path.exists(tgz_path):
+        urllib.request.urlretrieve(housing_url, tgz_path + ".part")
+        os.replace(tgz_path + ".part", tgz_path)
     housing_tgz = tarfile.open(tgz_path)
     housing_tgz.extractall(path=housing_path)
     housing_tgz.close()
 
 
-def load_housing_data(housing_path=HOUSING_PATH):
-    csv_path = housing_path
-    return pd.read_csv(csv_path)
-
-
-housing_df = load_housing_data()
+def read_housing_csv(csv_path):
+    # With explicit dtypes nothing has to be inferred while parsing; the pyarrow engine
+    # parses with several threads, fall back to the C engine when it is not installed
+    try:
+        return pd.read_csv(csv_path, engine="pyarrow", dtype=HOUSING_DTYPES)
+    except ImportError:
+        return pd.read_csv(csv_path, engine="c", dtype=HOUSING_DTYPES, low_memory=False)
+
+
+def _cached_load(housing_url=HOUSING_PATH, cache_dir=HOUSING_CACHE_DIR):
+    # The dataset never changes, so download it only once and keep a parquet copy next to it,
+    # which is much faster to read back than parsing the CSV again. The cached files are named
+    # after the URL, and are written through a .part file so that an interrupted write is never reused
+    stem = "housing-" + hashlib.blake2b(housing_url.encode(), digest_size=8).hexdigest()
+    parquet_path = os.path.join(cache_dir, stem + ".parquet")
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path)
+    csv_path = os.path.join(cache_dir, stem + ".csv")
+    if not os.path.exists(csv_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        urllib.request.urlretrieve(housing_url, csv_path + ".part")
+        os.replace(csv_path + ".part", csv_path)
+    housing = read_housing_csv(csv_path)
+    try:
+        housing.to_parquet(parquet_path + ".part")
+    except ImportError:  # no parquet engine (pyarrow/fastparquet) installed, keep using the CSV
+        pass
+    else:
+        os.replace(parquet_path + ".part", parquet_path)
+    return housing
 
-print(housing_df.describe())
 
-
-# housing_df.hist(bins=50, figsize=(20, 15))
-# plt.show()
+def load_housing_data(housing_path=HOUSING_PATH):
+    housing = _cached_load(housing_path)
+    # Nothing below needs double precision: make sure every numerical column is float32
+    float_columns = housing.select_dtypes("float64").columns
+    housing[float_columns] = housing[float_columns].astype(np.float32)
+    return housing
 
 
 #### Creating a test set
-def split_train_test(data, test_ratio):
-    shuffled_indices = np.random.permutation(len(data))
+def split_train_test(data, test_ratio, seed=None):
+    rng = np.random.default_rng(seed)
+    shuffled_indices = rng.permutation(len(data))
     test_set_size = int(len(data) * test_ratio)
     test_indices = shuffled_indices[:test_set_size]
     train_indices = shuffled_indices[test_set_size:]
-    return data.iloc[train_indices], data.iloc[test_indices]
+    return data.take(train_indices), data.take(test_indices)
 
 
-train_set, test_set = split_train_test(housing_df, 0.2)
-print("Train set:", len(train_set), "Test Set:", len(test_set))
-
 #### Creating a test set using a hash
-from zlib import crc32
-
-
 def test_set_check(identifier, test_ratio):
     return crc32(np.int64(identifier)) & 0xffffffff < test_ratio * 2 ** 32
 
 
-def split_train_test_by_id(data, test_ratio, id_column):
-    ids = data[id_column]
-    in_test_set = ids.apply(lambda id_: test_set_check(id_, test_ratio))
-    return data.loc[~in_test_set], data.loc[in_test_set]
+def _build_crc32_tables():
+    # Slice-by-8 tables: tables[k][b] is the CRC contribution of byte b followed by k zero bytes
+    tables = np.empty((8, 256), dtype=np.uint32)
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ np.uint32(0xEDB88320), table >> 1)
+    tables[0] = table
+    for k in range(1, 8):
+        tables[k] = (tables[k - 1] >> 8) ^ tables[0][tables[k - 1] & 0xFF]
+    return tables
 
 
-### unfortunately the housing dataset does not have an identifier column. The simplest solution is to use
-### the row index as the ID
-housing_with_id = housing_df.reset_index()  # adds an `index` column
-train_set, test_set = split_train_test_by_id(housing_with_id, 0.2, "index")
+CRC32_TABLES = _build_crc32_tables()
 
-### A district's latitude and longitude are guaranteed to be stable for a few millon years, so we could combine them into an ID like so:
-housing_with_id["id"] = housing_df["longitude"] * 1000 + housing_df["latitude"]
-train_set, test_set = split_train_test_by_id(housing_with_id, 0.2, "id")
 
-# Sckit-Learn a simplest function
+def crc32_vec(ids):
+    # Same value as crc32(np.int64(id_)) for every id, but computed for all the rows at once:
+    # with the slice-by-8 tables, the 8 bytes of each int64 are 8 independent lookups XORed together
+    # instead of a byte-by-byte chain, and there is no zlib call per row
+    words = np.ascontiguousarray(ids, dtype="<i8").view("<u4").reshape(-1, 2)
+    lo = words[:, 0] ^ np.uint32(0xFFFFFFFF)
+    hi = words[:, 1]
+    t = CRC32_TABLES
+    crc = (t[7][lo & 0xFF] ^ t[6][(lo >> 8) & 0xFF] ^ t[5][(lo >> 16) & 0xFF] ^ t[4][lo >> 24]
+           ^ t[3][hi & 0xFF] ^ t[2][(hi >> 8) & 0xFF] ^ t[1][(hi >> 16) & 0xFF] ^ t[0][hi >> 24])
+    return crc ^ np.uint32(0xFFFFFFFF)
 
-from sklearn.model_selection import train_test_split
 
-train_set, test_set = train_test_split(housing_df, test_size=0.2, random_state=42)
+def test_set_mask(ids, test_ratio):
+    return crc32_vec(ids) < int(test_ratio * 2 ** 32)
 
-# Lets use the function pd.cut to create an income category attribute with five categories
-housing_df["income_cat"] = pd.cut(housing_df["median_income"],
-                                  bins=[0., 1.5, 3.0, 4.5, 6., np.inf],
-                                  labels=[1, 2, 3, 4, 5])
 
-# housing_df["income_cat"].hist()
-# plt.show()
+def split_by_hash_mask(data, ids, test_ratio):
+    in_test_set = test_set_mask(ids, test_ratio)
+    return data.iloc[~in_test_set], data.iloc[in_test_set]
 
-### Now we can do stratified sampling based on the income category, using Scikit-Learn's StratifiedShuffleSplit class
-from sklearn.model_selection import StratifiedShuffleSplit
 
-split = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=42)
-for train_index, test_index in split.split(housing_df, housing_df["income_cat"]):
-    strat_train_set = housing_df.loc[train_index]
-    strat_test_set = housing_df.loc[test_index]
+def split_train_test_by_id(data, test_ratio, id_column):
+    return split_by_hash_mask(data, data[id_column].to_numpy(), test_ratio)
+
+
+### Stratified sampling. Scikit-Learn's StratifiedShuffleSplit class does this, but for a single split
+### it is enough to sort the rows by category once and to sample test_ratio of the rows of every category
+def stratified_split_indices(strata, test_ratio, seed=None):
+    rng = np.random.default_rng(seed)
+    strata = np.asarray(strata)
+    order = np.argsort(strata, kind="stable")
+    sorted_strata = strata[order]
+    levels = np.unique(sorted_strata)
+    bounds = np.append(np.searchsorted(sorted_strata, levels), len(strata))
+    test_index = np.concatenate([
+        rng.permutation(order[start:stop])[:round((stop - start) * test_ratio)]
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ])
+    train_index = np.setdiff1d(np.arange(len(strata)), test_index)
+    # Shuffle both sets like StratifiedShuffleSplit does: otherwise the training set is in file order,
+    # and the unshuffled folds of cross_val_score/GridSearchCV would be contiguous blocks of the CSV
+    return rng.permutation(train_index), rng.permutation(test_index)
+
+
+### Pearson correlation of every pair of numerical attributes computed with a few float32 matrix products,
+### ignoring missing values pair by pair like DataFrame.corr() does
+def fast_corr(df):
+    numeric = df.select_dtypes(include=np.number)
+    X = numeric.to_numpy(np.float32)
+    valid = ~np.isnan(X)
+    X = (X - np.nanmean(X, axis=0)) / np.nanstd(X, axis=0)  # standardized so the float32 sums stay accurate
+    X[~valid] = 0
+    M = valid.astype(np.float32)
+    n = M.T @ M  # number of rows where both attributes are present
+    sx = X.T @ M  # sum of attribute i over those rows
+    sxx = (X * X).T @ M  # sum of squares of attribute i over those rows
+    cov = X.T @ X - sx * sx.T / n
+    var = sxx - sx * sx / n
+    corr = cov / np.sqrt(var * var.T)
+    return pd.DataFrame(corr, index=numeric.columns, columns=numeric.columns)
+
+
+### Scatter Matrix, drawn with hexbins like pandas' scatter_matrix draws markers: a histogram of
+### every attribute on the diagonal and a hexbin plot of every pair of attributes off the diagonal
+def hexbin_matrix(frame, figsize=(12, 8), gridsize=30):
+    columns = list(frame)
+    n = len(columns)
+    fig, axes = plt.subplots(n, n, figsize=figsize)
+    for i, y in enumerate(columns):
+        for j, x in enumerate(columns):
+            ax = axes[i, j]
+            if i == j:
+                ax.hist(frame[x].dropna(), bins=50)
+            else:
+                ax.hexbin(frame[x], frame[y], gridsize=gridsize, mincnt=1, cmap="Blues")
+            ax.set_xlabel(x if i == n - 1 else "")
+            ax.set_ylabel(y if j == 0 else "")
+    return axes
+
+
+# Scikit-Learn's SimpleImputer(strategy="median") takes care of missing values.
+# For a few numerical columns, np.nanmedian and an in-place fill of the NaNs do the same thing directly
+class MedianImputer(BaseEstimator, TransformerMixin):
+    def fit(self, X, y=None):
+        self.statistics_ = np.nanmedian(np.asarray(X, dtype=np.float64), axis=0)
+        return self
 
-### Let's see if it worked as expected
-print(strat_test_set["income_cat"].value_counts() / len(strat_test_set))
+    def transform(self, X):
+        X = np.asarray(X)
+        X = X.astype(np.result_type(X.dtype, np.float32))  # always a copy, the input is left untouched
+        np.copyto(X, self.statistics_, where=np.isnan(X), casting="unsafe")
+        return X
 
-### Let's remove `income_cat` attribute so the data is back to its original state:
 
-for set_ in (strat_train_set, strat_test_set):
-    set_.drop("income_cat", axis=1, inplace=True)
+# CUSTOME TRANSFORMERS FOR TJE COMBINE ATTRIBUTES
+rooms_ix, bedroom_ix, population_ix, households_ix = 3, 4, 5, 6
 
-### Discover and visualize the data gain insights
-housing = strat_train_set.copy()
 
-### Visualizing geographical data
-housing.plot(kind="scatter", x="longitude", y="latitude", alpha=0.1)
-#plt.show()
+def combined_attributes_buffer(X, add_bedrooms_per_room):
+    # Preallocate the output with X in its first columns, the new attributes are then written
+    # straight into it instead of being concatenated with np.c_, which copies every column again
+    n, m = X.shape
+    k = 3 if add_bedrooms_per_room else 2
+    out = np.empty((n, m + k), dtype=np.result_type(X.dtype, np.float32))
+    out[:, :m] = X
+    return out
 
-### Visualizing the housing prices
-housing.plot(kind="scatter", x="longitude", y="latitude", alpha=0.4,
-             s=housing["population"] / 100, label="population", figsize=(10, 7),
-             c="median_house_value", cmap=plt.get_cmap("jet"), colorbar=True)
-plt.legend()
-#plt.show()
 
-### Looking for correlations
-corr_matrix = housing.corr()
+def fill_combined_attributes(out, m, add_bedrooms_per_room):
+    np.divide(out[:, rooms_ix], out[:, households_ix], out=out[:, m])  # rooms_per_household
+    np.divide(out[:, population_ix], out[:, households_ix], out=out[:, m + 1])  # population_per_household
+    if add_bedrooms_per_room:
+        np.divide(out[:, bedroom_ix], out[:, rooms_ix], out=out[:, m + 2])  # bedrooms_per_room
 
-corr_matrix["median_house_value"].sort_values(ascending=False)
 
-### Scatter Matrix using Pandas
-from pandas.plotting import scatter_matrix
+class CombinedAttributesAdder(BaseEstimator, TransformerMixin):
+    def __init__(self, add_bedrooms_per_room=True):
+        self.add_bedrooms_per_room = add_bedrooms_per_room
 
-attributes = ["median_house_value", "median_income", "total_rooms",
-              "housing_median_age"]
+    def fit(self, X, y=None):
+        return self  # Nothing else to do
 
-scatter_matrix(housing[attributes], figsize=(12, 8))
-#plt.show()
+    def transform(self, X):
+        out = combined_attributes_buffer(X, self.add_bedrooms_per_room)
+        fill_combined_attributes(out, X.shape[1], self.add_bedrooms_per_room)
+        return out
 
 
-### Zoom in the median income correlation scatterplot
-housing.plot(kind="scatter", x="median_income", y="median_house_value",
-             alpha=0.1)
-#plt.show()
+# Below this many columns, dispatching the scaling to several threads costs more than it saves
+PARALLEL_SCALE_MIN_COLUMNS = 16
 
-### Experimenting with attribute combinations
-housing["rooms_per_household"] = housing["total_rooms"] / housing["households"]
-housing["bedrooms_per_room"] = housing["total_bedrooms"] / housing["total_rooms"]
-housing["population_per_household"] = housing["population"] / housing["households"]
 
-## Let's see the crrelation matrix again
-corr_matrix = housing.corr()
-print(corr_matrix["median_house_value"].sort_values(ascending=False))
+def _scale_columns(out, mean, scale, start, stop):
+    out[:, start:stop] -= mean[start:stop]
+    out[:, start:stop] /= scale[start:stop]
 
-### Prepare the data for Machine Learning Algorithms
 
-housing = strat_train_set.drop("median_house_value", axis=1)
-housing_labels = strat_train_set["median_house_value"].copy()
+# The numerical pipeline is Pipeline([('imputer', MedianImputer()), ('attribs_adder', CombinedAttributesAdder()),
+# ('std_scaler', StandardScaler())]). Each of these steps makes its own full copy of the data, so the three of them
+# are fused into one transformer: the NaNs are filled, the combined attributes added and the columns standardized
+# in a single output array
+class NumericPipeline(BaseEstimator, TransformerMixin):
+    def __init__(self, add_bedrooms_per_room=True, n_jobs=None):
+        self.add_bedrooms_per_room = add_bedrooms_per_room
+        self.n_jobs = n_jobs
+
+    def _impute_and_combine(self, X):
+        m = X.shape[1]
+        out = combined_attributes_buffer(X, self.add_bedrooms_per_room)
+        imputed = out[:, :m]
+        np.copyto(imputed, self.statistics_, where=np.isnan(imputed), casting="unsafe")
+        fill_combined_attributes(out, m, self.add_bedrooms_per_room)
+        return out
+
+    def _scale(self, out):
+        n_columns = out.shape[1]
+        if self.n_jobs is None or n_columns < PARALLEL_SCALE_MIN_COLUMNS:
+            _scale_columns(out, self.mean_, self.scale_, 0, n_columns)
+            return out
+        # Scale blocks of columns in place from several threads, NumPy releases the GIL while doing so
+        bounds = np.linspace(0, n_columns, effective_n_jobs(self.n_jobs) + 1).astype(int)
+        Parallel(n_jobs=self.n_jobs, prefer="threads")(
+            delayed(_scale_columns)(out, self.mean_, self.scale_, start, stop)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        )
+        return out
+
+    def fit_transform(self, X, y=None):
+        X = np.asarray(X)
+        self.statistics_ = np.nanmedian(np.asarray(X, dtype=np.float64), axis=0)
+        out = self._impute_and_combine(X)
+        self.mean_ = out.mean(axis=0, dtype=np.float64)
+        scale = out.std(axis=0, dtype=np.float64)
+        scale[scale == 0] = 1.0  # like StandardScaler, leave constant columns unscaled
+        self.scale_ = scale
+        return self._scale(out)
 
-## Data Cleaning
-# Missing values in total_bedrooms
+    def fit(self, X, y=None):
+        self.fit_transform(X)
+        return self
 
-# Option 1: Get rid of the corresponding districts
-# housing.dropna(subset=["total_bedrooms"])
+    def transform(self, X):
+        return self._scale(self._impute_and_combine(np.asarray(X)))
+
+
+def prepare(data):
+    # Numerical attributes, ocean_proximity category codes and labels as plain arrays
+    X_num = data[NUM_ATTRIBS].to_numpy(np.float32)
+    X_cat = data["ocean_proximity"].cat.codes.to_numpy(np.int8)
+    y = data["median_house_value"].to_numpy(np.float32)
+    return X_num, X_cat, y
+
+
+def fit_transform_cached(pipeline, data, cache_dir=HOUSING_CACHE_DIR):
+    # Fitting is deterministic given the data, the pipeline's parameters, the code of the transformers and
+    # the Scikit-Learn version, so the fitted pipeline is saved under a key made of these and loaded back
+    # instead of refitted. Pickle only stores the custom transformers by name, so this module's source is
+    # part of the key. Returns the fitted pipeline and the transformed data
+    with open(__file__, "rb") as source:
+        source_digest = hashlib.blake2b(source.read(), digest_size=8).hexdigest()
+    key = sklearn.__version__ + source_digest + joblib.hash(clone(pipeline)) + joblib.hash(data)
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    cache_path = os.path.join(cache_dir, f"pipeline-{digest}.joblib")
+    if os.path.exists(cache_path):
+        pipeline = joblib.load(cache_path, mmap_mode="r")
+        return pipeline, pipeline.transform(data)
+    prepared = pipeline.fit_transform(data)
+    os.makedirs(cache_dir, exist_ok=True)
+    joblib.dump(pipeline, cache_path + ".part")
+    os.replace(cache_path + ".part", cache_path)
+    return pipeline, prepared
 
-# Option 2: Get rid of the whole attribute
-# housing.drop("total_bedrooms, axis=1")
 
-# Option 3: Set the values to some value (zero, the mean, the median, etc)
-# median = housing["total_bedrooms"].median()
-# housing["total_rooms"].fillna(median, inplace=True)
+def display_scores(scores):
+    logger.info("Scores: %s", scores)
+    logger.info("Mean: %s", scores.mean())
+    logger.info("Standard deviation: %s", scores.std())
 
-# Scikit-Learn to take care of missing values
 
-from sklearn.impute import SimpleImputer
+def main():
+    # The diagnostic dumps below are only computed when they are going to be logged
+    debug = logger.isEnabledFor(logging.DEBUG)
 
-imputer = SimpleImputer(strategy="median")
+    housing_df = load_housing_data()
 
-# the imputer can only be computed on numerical attributes, so lets create a copy without ocean_proximity
-housing_num = housing.drop("ocean_proximity", axis=1)
+    if debug:
+        logger.debug("%s", housing_df.describe())
 
-imputer.fit(housing_num)
+    # housing_df.hist(bins=50, figsize=(20, 15))
+    # plt.show()
 
-print(imputer.statistics_)
-print(housing_num.median().values)
+    #### Creating a test set
+    train_set, test_set = split_train_test(housing_df, 0.2)
+    logger.debug("Train set: %d Test Set: %d", len(train_set), len(test_set))
 
-X = imputer.transform(housing_num)
+    #### Creating a test set using a hash
+    ### The ids are only needed to build the test mask, so they are kept as NumPy arrays next to the data
+    ### instead of being stored in a DataFrame column
 
-housing_tr = pd.DataFrame(X, columns=housing_num.columns,
-                          index=housing_num.index)
+    ### unfortunately the housing dataset does not have an identifier column. The simplest solution is to use
+    ### the row index as the ID
+    train_set, test_set = split_by_hash_mask(housing_df, np.arange(len(housing_df), dtype=np.int64), 0.2)
 
-print(housing_tr.head())
+    ### A district's latitude and longitude are guaranteed to be stable for a few millon years, so we could combine them into an ID like so:
+    # The coordinates are parsed as float32: round them back to their 2 decimals in float64 first,
+    # otherwise the float32 rounding error can move an id to the next integer when it is truncated
+    longitude = np.round(housing_df["longitude"].to_numpy(np.float64), 2)
+    latitude = np.round(housing_df["latitude"].to_numpy(np.float64), 2)
+    ids = (longitude * 1000 + latitude).astype(np.int64)
+    train_set, test_set = split_by_hash_mask(housing_df, ids, 0.2)
 
-### HANDLING TEXT AND CATEGORICAL ATTRIBUTES
-housing_cat = housing[["ocean_proximity"]]
-print("10 categories", housing_cat.head(10))
+    # Sckit-Learn a simplest function
+    train_set, test_set = train_test_split(housing_df, test_size=0.2, random_state=42)
 
-## Convert text to numbers
-from sklearn.preprocessing import OrdinalEncoder
+    # Lets create an income category attribute with five categories: (0, 1.5] is 1, (1.5, 3] is 2, ..., (6, inf) is 5.
+    # It is only used as a stratification key, so a plain int8 column is enough (no need for pd.cut's Categorical)
+    housing_df["income_cat"] = (np.digitize(housing_df["median_income"].to_numpy(np.float32),
+                                            [1.5, 3.0, 4.5, 6.], right=True) + 1).astype(np.int8)
 
-ordinal_encoder = OrdinalEncoder()
-housing_cat_encoded = ordinal_encoder.fit_transform(housing_cat)
-print(housing_cat_encoded[:10])
+    # housing_df["income_cat"].hist()
+    # plt.show()
 
-print(ordinal_encoder.categories_)
+    ### Now we can do stratified sampling based on the income category
+    income_cat = housing_df["income_cat"]
+    train_index, test_index = stratified_split_indices(income_cat.to_numpy(), 0.2, seed=42)
 
-## ONE HOT ENCODER
-from sklearn.preprocessing import OneHotEncoder
+    ### Let's see if it worked as expected
+    if debug:
+        logger.debug("%s", income_cat.iloc[test_index].value_counts() / len(test_index))
 
-cat_encoder = OneHotEncoder()
+    ### `income_cat` is not needed anymore, so leave it out while taking the rows and the sets are back to the original attributes:
+    keep = [i for i, column in enumerate(housing_df.columns) if column != "income_cat"]
+    strat_train_set = housing_df.iloc[train_index, keep]
+    strat_test_set = housing_df.iloc[test_index, keep]
 
-housing_cat_1hot = cat_encoder.fit_transform(housing_cat)
-print("ONE-HOT ENCODER array", housing_cat_1hot.toarray())
+    ### Discover and visualize the data gain insights
+    housing = strat_train_set.copy()
 
-print("Categories", cat_encoder.categories_)
+    ### Visualizing geographical data
+    ### A hexbin plot counts the districts per cell, which shows the density without drawing one marker per district
+    housing.plot(kind="hexbin", x="longitude", y="latitude", gridsize=80, mincnt=1, cmap="Blues")
+    #plt.show()
 
-# CUSTOME TRANSFORMERS FOR TJE COMBINE ATTRIBUTES MENTIONED EARLIER
-from sklearn.base import BaseEstimator, TransformerMixin
+    ### Visualizing the housing prices
+    norm = plt.Normalize(housing["median_house_value"].min(), housing["median_house_value"].max())
+    housing.plot(kind="hexbin", x="longitude", y="latitude", C="median_house_value",
+                 reduce_C_function=np.mean, gridsize=80, figsize=(10, 7),
+                 cmap=CMAP, norm=norm, colorbar=True)
+    #plt.show()
 
-rooms_ix, bedroom_ix, population_ix, households_ix = 3, 4, 5, 6
+    ### Looking for correlations
+    corr_matrix = fast_corr(housing)
 
+    corr_matrix["median_house_value"].sort_values(ascending=False)
 
-class CombinedAttributesAdder(BaseEstimator, TransformerMixin):
-    def __init__(self, add_bedrooms_per_room=True):
-        self.add_bedrooms_per_room = add_bedrooms_per_room
+    ### Scatter Matrix
+    attributes = ["median_house_value", "median_income", "total_rooms",
+                  "housing_median_age"]
 
-    def fit(self, X, y=None):
-        return self  # Nothing else to do
+    hexbin_matrix(housing[attributes], figsize=(12, 8))
+    #plt.show()
 
-    def transform(self, X):
-        rooms_per_household = X[:, rooms_ix] / X[:, households_ix]
-        population_per_household = X[:, population_ix] / X[:, households_ix]
-        if self.add_bedrooms_per_room:
-            bedrooms_per_room = X[:, bedroom_ix] / X[:, rooms_ix]
-            return np.c_[X, rooms_per_household, population_per_household, bedrooms_per_room]
-        else:
-            return np.c_[X, rooms_per_household, population_per_household]
+    ### Zoom in the median income correlation scatterplot
+    housing.plot(kind="hexbin", x="median_income", y="median_house_value",
+                 gridsize=80, mincnt=1, cmap="Blues")
+    #plt.show()
 
+    ### Experimenting with attribute combinations
+    housing["rooms_per_household"] = housing["total_rooms"] / housing["households"]
+    housing["bedrooms_per_room"] = housing["total_bedrooms"] / housing["total_rooms"]
+    housing["population_per_household"] = housing["population"] / housing["households"]
 
-attr_adder = CombinedAttributesAdder(add_bedrooms_per_room=False)
-housing_extra_attribs = attr_adder.transform(housing.values)
+    ## Let's see the crrelation matrix again
+    corr_matrix = fast_corr(housing)
+    if debug:
+        logger.debug("%s", corr_matrix["median_house_value"].sort_values(ascending=False))
 
-## TRANSFORMATION PIPELINES
+    ### Prepare the data for Machine Learning Algorithms
+    ### The numerical attributes, the category codes and the labels are taken out of the DataFrame once,
+    ### every step below works on these arrays
+    X_num, X_cat, housing_labels = prepare(strat_train_set)
 
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler
+    ## Data Cleaning
+    # Missing values in total_bedrooms
 
-num_pipeline = Pipeline([
-    ('imputer', SimpleImputer(strategy="median")),
-    ('attribs_adder', CombinedAttributesAdder()),
-    ('std_scaler', StandardScaler())
-])
-housing_num_tr = num_pipeline.fit_transform(housing_num)
-print('housing num:', housing_num)
-print('housing_num_tr:', housing_num_tr)
+    # Option 1: Get rid of the corresponding districts
+    # housing.dropna(subset=["total_bedrooms"])
 
-## COLUMN TRANSFORMER
-from sklearn.compose import ColumnTransformer
+    # Option 2: Get rid of the whole attribute
+    # housing.drop("total_bedrooms, axis=1")
 
-num_attribs = list(housing_num)
-cat_attribs = ["ocean_proximity"]
+    # Option 3: Set the values to some value (zero, the mean, the median, etc)
+    # median = housing["total_bedrooms"].median()
+    # housing["total_rooms"].fillna(median, inplace=True)
 
-full_pipeline = ColumnTransformer([
-    ("num", num_pipeline, num_attribs),
-    ("cat", OneHotEncoder(), cat_attribs),
-])
+    # Let a transformer take care of missing values
+    imputer = MedianImputer()
 
-housing_prepared = full_pipeline.fit_transform(housing)
+    # the imputer can only be computed on numerical attributes, so it is fitted on X_num, without ocean_proximity
+    imputer.fit(X_num)
 
-print('housing_prepared:', housing_prepared)
+    logger.debug("%s", imputer.statistics_)
+    if debug:
+        logger.debug("%s", np.nanmedian(X_num, axis=0))
 
-### SELECT AND TRAIN A MODEL
+    X = imputer.transform(X_num)
 
-from sklearn.linear_model import LinearRegression
+    logger.debug("%s", X[:5])
 
-lin_reg = LinearRegression()
-lin_reg.fit(housing_prepared, housing_labels)
+    ### HANDLING TEXT AND CATEGORICAL ATTRIBUTES
+    logger.debug("10 categories %s", strat_train_set["ocean_proximity"].head(10))
 
-# Let's try it out on a few instances from the begining
+    ## Convert text to numbers
+    # ocean_proximity is loaded as a categorical column, so its codes already are what OrdinalEncoder would compute
+    housing_cat_encoded = X_cat
+    logger.debug("%s", housing_cat_encoded[:10])
 
-some_data = housing.iloc[:5]
-some_labels = housing_labels.iloc[:5]
-some_data_prepared = full_pipeline.transform(some_data)
-print("Predictions:", lin_reg.predict(some_data_prepared))
+    logger.debug("%s", strat_train_set["ocean_proximity"].cat.categories)
 
-print("Labels:", list(some_labels))
+    ## ONE HOT ENCODER
+    cat_encoder = OneHotEncoder()
 
-## LET'S MEASURE THIS REGRESSION MODEL'S RMSE ON THE WHOLE TRAINING SET USING SCIKIT-LEARN'S MEAN_SQUARED_ERROR()
+    housing_cat_1hot = cat_encoder.fit_transform(strat_train_set[CAT_ATTRIBS])
+    if debug:
+        logger.debug("ONE-HOT ENCODER array %s", housing_cat_1hot.toarray())
 
-from sklearn.metrics import mean_squared_error
+    logger.debug("Categories %s", cat_encoder.categories_)
 
-housing_predictions = lin_reg.predict(housing_prepared)
-lin_mse = mean_squared_error(housing_labels, housing_predictions)
-lin_rmse = np.sqrt(lin_mse)
-print("RMSE:", lin_rmse)
+    # COMBINE ATTRIBUTES MENTIONED EARLIER
+    attr_adder = CombinedAttributesAdder(add_bedrooms_per_room=False)
+    housing_extra_attribs = attr_adder.transform(X_num)
 
-# Let's use a powerful model - DECISION TREE MODEL
+    ## TRANSFORMATION PIPELINES
+    num_pipeline = NumericPipeline(n_jobs=-1)
+    housing_num_tr = num_pipeline.fit_transform(X_num)
+    logger.debug("housing num: %s", X_num)
+    logger.debug("housing_num_tr: %s", housing_num_tr)
 
-from sklearn.tree import DecisionTreeRegressor
+    ## COLUMN TRANSFORMER
+    # The columns are selected by name, so the full pipeline is applied directly to the stratified sets:
+    # median_house_value is not selected and is dropped by the transformer
+    num_attribs = NUM_ATTRIBS
+    cat_attribs = CAT_ATTRIBS
 
-tree_reg = DecisionTreeRegressor()
-tree_reg.fit(housing_prepared, housing_labels)
+    # Most of the prepared columns are dense and the tree and forest models below are much slower on sparse
+    # input, so the prepared data is a dense float32 array (a sparse matrix would also be larger here).
+    # The numerical and categorical transformers are independent, so they are fitted in parallel
+    full_pipeline = ColumnTransformer([
+        ("num", num_pipeline, num_attribs),
+        ("cat", OneHotEncoder(sparse_output=False, dtype=np.float32), cat_attribs),
+    ], sparse_threshold=0, n_jobs=-1)
 
-## Let's evaluate it
-housing_predictions = tree_reg.predict(housing_prepared)
-tree_mse = mean_squared_error(housing_labels, housing_predictions)
-tree_rmse = np.sqrt(tree_mse)
-print("DECISION TREE RMSE:", tree_rmse)
+    full_pipeline, housing_prepared = fit_transform_cached(full_pipeline, strat_train_set)
 
-## Let's randomly splits the training set into 10 distinct subset called 'folds'
-## Then it trains and evaluates the Decision Tree model 10 times,
-# picking a different fold for evaluation every time and training on the other 9 folds. The result is an array containing the 10 evaluation socres:
+    logger.debug("housing_prepared: %s", housing_prepared)
+    logger.debug("housing_prepared dtype: %s", housing_prepared.dtype)  # float32 from end to end
 
-from sklearn.model_selection import cross_val_score
+    ### SELECT AND TRAIN A MODEL
+    lin_reg = LinearRegression()
+    lin_reg.fit(housing_prepared, housing_labels)
 
-scores = cross_val_score(tree_reg, housing_prepared, housing_labels,
-                         scoring="neg_mean_squared_error", cv=10)
-tree_rmse_scores = np.sqrt(-scores)
+    # Let's try it out on a few instances from the begining
 
+    some_data = strat_train_set.iloc[:5]
+    some_labels = housing_labels[:5]
+    some_data_prepared = full_pipeline.transform(some_data)
+    if debug:
+        logger.debug("Predictions: %s", lin_reg.predict(some_data_prepared))
 
-def display_scores(scores):
-    print("Scores:", scores)
-    print("Mean:", scores.mean())
-    print("Standard deviation:", scores.std())
+    logger.debug("Labels: %s", some_labels.tolist())
 
+    ## LET'S MEASURE THIS REGRESSION MODEL'S RMSE ON THE WHOLE TRAINING SET USING SCIKIT-LEARN'S MEAN_SQUARED_ERROR()
+    housing_predictions = lin_reg.predict(housing_prepared)
+    lin_mse = mean_squared_error(housing_labels, housing_predictions)
+    lin_rmse = np.sqrt(lin_mse)
+    logger.info("RMSE: %s", lin_rmse)
 
-display_scores(tree_rmse_scores)
+    # Let's use a powerful model - DECISION TREE MODEL
+    tree_reg = DecisionTreeRegressor()
+    tree_reg.fit(housing_prepared, housing_labels)
 
-## lETS COMPUTE THE SAME SCORES FOR THE LINEAR REGRESSION MODEL JUST TO BE SURE
-lin_scores = cross_val_score(lin_reg, housing_prepared, housing_labels, scoring="neg_mean_squared_error", cv=10)
+    ## Let's evaluate it
+    housing_predictions = tree_reg.predict(housing_prepared)
+    tree_mse = mean_squared_error(housing_labels, housing_predictions)
+    tree_rmse = np.sqrt(tree_mse)
+    logger.info("DECISION TREE RMSE: %s", tree_rmse)
 
-lin_rmse_scores = np.sqrt(-lin_scores)
-display_scores(lin_rmse_scores)
+    ## Let's randomly splits the training set into 10 distinct subset called 'folds'
+    ## Then it trains and evaluates the Decision Tree model 10 times,
+    # picking a different fold for evaluation every time and training on the other 9 folds. The result is an array containing the 10 evaluation socres:
+    scores = cross_val_score(tree_reg, housing_prepared, housing_labels,
+                             scoring="neg_mean_squared_error", cv=10)
+    tree_rmse_scores = np.sqrt(-scores)
 
-## Lets try one last model: RandomForestRegressor
-from sklearn.ensemble import RandomForestRegressor
+    display_scores(tree_rmse_scores)
 
-forest_reg = RandomForestRegressor()
-forest_reg.fit(housing_prepared, housing_labels)
-housing_predictions = forest_reg.predict(housing_prepared)
-forest_mse = mean_squared_error(housing_labels, housing_predictions)
-forest_rmse = np.sqrt(forest_mse)
-print('forest_rmese:', forest_rmse)
+    ## lETS COMPUTE THE SAME SCORES FOR THE LINEAR REGRESSION MODEL JUST TO BE SURE
+    lin_scores = cross_val_score(lin_reg, housing_prepared, housing_labels, scoring="neg_mean_squared_error", cv=10)
 
-scores = cross_val_score(forest_reg, housing_prepared, housing_labels,
-                         scoring="neg_mean_squared_error", cv=10)
-forest_rmse_scores = np.sqrt(-scores)
+    lin_rmse_scores = np.sqrt(-lin_scores)
+    display_scores(lin_rmse_scores)
 
-display_scores(forest_rmse_scores)
+    ## Lets try one last model: RandomForestRegressor
+    forest_reg = RandomForestRegressor()
+    forest_reg.fit(housing_prepared, housing_labels)
+    housing_predictions = forest_reg.predict(housing_prepared)
+    forest_mse = mean_squared_error(housing_labels, housing_predictions)
+    forest_rmse = np.sqrt(forest_mse)
+    logger.info("forest_rmese: %s", forest_rmse)
 
-###### FINE-TUNE A MODEL
+    scores = cross_val_score(forest_reg, housing_prepared, housing_labels,
+                             scoring="neg_mean_squared_error", cv=10)
+    forest_rmse_scores = np.sqrt(-scores)
 
-## GRID SEARCH
-from sklearn.model_selection import GridSearchCV
+    display_scores(forest_rmse_scores)
 
-param_grid = [
-    {'n_estimators': [3, 10, 30], 'max_features': [2, 4, 6, 8]},
-    {'bootstrap': [False], 'n_estimators': [3, 10], 'max_features': [2, 3, 4]}
-]
+    ###### FINE-TUNE A MODEL
 
-forest_reg = RandomForestRegressor()
+    ## GRID SEARCH
+    param_grid = [
+        {'n_estimators': [3, 10, 30], 'max_features': [2, 4, 6, 8]},
+        {'bootstrap': [False], 'n_estimators': [3, 10], 'max_features': [2, 3, 4]}
+    ]
 
-grid_search = GridSearchCV(forest_reg, param_grid, cv=5,
-                           scoring='neg_mean_squared_error',
-                           return_train_score=True)
+    forest_reg = RandomForestRegressor()
 
-grid_search.fit(housing_prepared, housing_labels)
+    grid_search = GridSearchCV(forest_reg, param_grid, cv=5,
+                               scoring='neg_mean_squared_error',
+                               return_train_score=True)
 
-print(grid_search.best_params_)
+    grid_search.fit(housing_prepared, housing_labels)
 
-print("Grid Search - Best estimator", grid_search.best_estimator_)
+    logger.info("%s", grid_search.best_params_)
 
-cvres = grid_search.cv_results_
-for mean_score, params in zip(cvres["mean_test_score"], cvres["params"]):
-    print(np.sqrt(-mean_score), params)
+    logger.info("Grid Search - Best estimator %s", grid_search.best_estimator_)
 
-# Analyze the best models and their errors
-feature_importances = grid_search.best_estimator_.feature_importances_
-print("Feature Importances", feature_importances)
+    cvres = grid_search.cv_results_
+    for mean_score, params in zip(cvres["mean_test_score"], cvres["params"]):
+        logger.debug("%s %s", np.sqrt(-mean_score), params)
 
-# Let's display thes importance scores next to their corresponding attribute names
+    # Analyze the best models and their errors
+    feature_importances = grid_search.best_estimator_.feature_importances_
+    logger.debug("Feature Importances %s", feature_importances)
 
-extra_attribs = ["rooms_per_hhold", "pop_per_hhold", "bedrooms_per_room"]
-cat_encoder = full_pipeline.named_transformers_["cat"]
-cat_one_hot_attribs = list(cat_encoder.categories_[0])
-attributes = num_attribs + extra_attribs + cat_one_hot_attribs
-print(sorted(zip(feature_importances, attributes), reverse=True))
+    # Let's display thes importance scores next to their corresponding attribute names
+    extra_attribs = ["rooms_per_hhold", "pop_per_hhold", "bedrooms_per_room"]
+    cat_encoder = full_pipeline.named_transformers_["cat"]
+    cat_one_hot_attribs = list(cat_encoder.categories_[0])
+    attributes = num_attribs + extra_attribs + cat_one_hot_attribs
+    logger.info("%s", sorted(zip(feature_importances, attributes), reverse=True))
 
-###### EVALUATE YOUR SYSTEM ON THE TEST SET
+    ###### EVALUATE YOUR SYSTEM ON THE TEST SET
 
-final_model = grid_search.best_estimator_
+    final_model = grid_search.best_estimator_
 
-X_test = strat_test_set.drop("median_house_value", axis=1)
-y_test = strat_test_set["median_house_value"].copy()
+    y_test = strat_test_set["median_house_value"].to_numpy(np.float32)
 
-X_test_prepared = full_pipeline.transform(X_test)
-final_predictions = final_model.predict(X_test_prepared)
+    X_test_prepared = full_pipeline.transform(strat_test_set)
+    final_predictions = final_model.predict(X_test_prepared)
 
-final_mse = mean_squared_error(y_test, final_predictions)
-final_rmse = np.sqrt(final_mse)
+    final_mse = mean_squared_error(y_test, final_predictions)
+    final_rmse = np.sqrt(final_mse)
 
-# You might want to have an idea of how precise this estimate is, you can compute a 95% confidence interval for the generalization error
+    # You might want to have an idea of how precise this estimate is, you can compute a 95% confidence interval for the generalization error
+    confidence = 0.95
+    squared_errors = (final_predictions - y_test) ** 2
+    confidence_interval = np.sqrt(stats.t.interval(confidence, len(squared_errors) - 1,
+                             loc=squared_errors.mean(),
+                             scale=stats.sem(squared_errors)))
+    logger.info("Confidence Interval %s", confidence_interval)
 
-from scipy import stats
 
-confidence = 0.95
-squared_errors = (final_predictions - y_test) ** 2
-confidence_interval = np.sqrt(stats.t.interval(confidence, len(squared_errors) - 1,
-                         loc=squared_errors.mean(),
-                         scale=stats.sem(squared_errors)))
-print("Confidence Interval",confidence_interval)
\ No newline at end of file
+if __name__ == "__main__":
+    # The plots are only drawn, never shown, when this runs as a script: render them with the Agg raster backend
+    # instead of an interactive one. Set MPLBACKEND to choose another backend
+    if not sys.flags.interactive and "MPLBACKEND" not in os.environ:
+        matplotlib.use("Agg")
+    logging.basicConfig(level=os.environ.get("ML_BOOK_LOG_LEVEL", "INFO"), format="%(message)s")
+    main()